@@ -0,0 +1,114 @@
+# 会話を圧縮 JSONL / Parquet でやり取りするためのシリアライズ処理
+# どれもレコードのジェネレータを受け取り、バッチ単位で読み書きするのでアーカイブ全体をメモリに載せない
+import gzip
+import json
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # JSONL だけを使うなら pyarrow は無くてもよい
+    pa = None
+    pq = None
+
+EXPORT_FORMATS = {"JSONL (gzip)": "jsonl.gz", "Parquet": "parquet"}
+EXPORT_BATCH_ROWS = 1000
+MESSAGE_ROLES = ("system", "user", "assistant")
+ARCHIVE_SCHEMA = pa.schema([
+    ("session_id", pa.string()),
+    ("index", pa.int64()),
+    ("role", pa.string()),
+    ("content", pa.string()),
+    ("route", pa.string()),
+]) if pa is not None else None
+
+
+def require_pyarrow():
+    if pq is None:
+        raise ImportError("Parquet の読み書きには pyarrow が必要です (`pip install pyarrow`)。")
+
+
+def iter_session_records(session_id, messages):
+    for i, msg in enumerate(messages):
+        yield {
+            "session_id": session_id,
+            "index": i,
+            "role": msg["role"],
+            "content": msg["content"],
+            "route": msg.get("route"),
+        }
+
+
+def iter_record_batches(records):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= EXPORT_BATCH_ROWS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_archive(records, fileobj, fmt):
+    if fmt == "parquet":
+        require_pyarrow()
+        with pq.ParquetWriter(fileobj, ARCHIVE_SCHEMA, compression="zstd") as writer:
+            for batch in iter_record_batches(records):
+                writer.write_table(pa.Table.from_pylist(batch, schema=ARCHIVE_SCHEMA))
+    else:
+        with gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=6) as gz:
+            for batch in iter_record_batches(records):
+                lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch)
+                gz.write(lines.encode("utf-8"))
+
+
+def iter_archive_records(fileobj, fmt):
+    if fmt == "parquet":
+        require_pyarrow()
+        for batch in pq.ParquetFile(fileobj).iter_batches(batch_size=EXPORT_BATCH_ROWS):
+            yield from batch.to_pylist()
+    else:
+        with gzip.GzipFile(fileobj=fileobj, mode="rb") as gz:
+            for line in gz:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def iter_archive_sessions(records):
+    # 同じ session_id のレコードが連続している前提で、セッションごとにまとめる
+    session_id = None
+    messages = []
+    for record in records:
+        if not isinstance(record, dict):
+            raise ValueError(f"不正なレコードです: {record!r}")
+        if record.get("session_id") != session_id:
+            if messages:
+                yield session_id, messages
+            session_id = record.get("session_id")
+            messages = []
+        message = {"role": record.get("role"), "content": record.get("content")}
+        if record.get("route"):
+            message["route"] = record["route"]
+        messages.append(message)
+    if messages:
+        yield session_id, messages
+
+
+def validate_messages(messages, system_prompt):
+    # 読み込んだ会話をそのまま st.session_state.messages に入れても描画で落ちないことを確かめる
+    for i, msg in enumerate(messages):
+        if not isinstance(msg, dict) or msg.get("role") not in MESSAGE_ROLES:
+            role = msg.get("role") if isinstance(msg, dict) else msg
+            raise ValueError(f"{i + 1}件目のメッセージの role が不正です: {role!r}")
+        if not isinstance(msg.get("content"), str):
+            raise ValueError(f"{i + 1}件目のメッセージの content が文字列ではありません。")
+        if "route" in msg and not isinstance(msg["route"], str):
+            raise ValueError(f"{i + 1}件目のメッセージの route が文字列ではありません。")
+    if not messages or messages[0]["role"] != "system":
+        messages.insert(0, {"role": "system", "content": system_prompt})
+    return messages
+
+
+def archive_format(file_name):
+    return "parquet" if file_name.endswith(".parquet") else "jsonl.gz"
@@ -0,0 +1,114 @@
+# 回答のマークダウンを段落・フェンス付きコード・表のブロックに分割する
+# Streamlit に依存しないので単体でテストできる
+import re
+
+LIST_MARKER = re.compile(r" {0,3}(?:[-*+]|\d{1,9}[.)])(?:\s|$)")
+REFERENCE_DEFINITION = re.compile(r"^ {0,3}\[[^\]]+\]:[ \t]*\S.*$", re.MULTILINE)
+
+
+def opening_fence(stripped):
+    # ``` や ~~~ (3文字以上) で始まる行なら、そのフェンス文字列を返す
+    for char in "`~":
+        run = len(stripped) - len(stripped.lstrip(char))
+        if run >= 3:
+            return stripped[:run]
+    return None
+
+
+def is_closing_fence(stripped, fence):
+    # 開始と同じ文字で、開始以上の長さだけからなる行で閉じる
+    return len(stripped) >= len(fence) and not stripped.strip(fence[0])
+
+
+def code_body_line_count(text):
+    # フェンスの行を除いたコード本体の行数。閉じていない (受信中の) ブロックにも使える
+    lines = text.strip("\n").split("\n")
+    count = len(lines) - 1
+    fence = opening_fence(lines[0].strip())
+    if count and fence is not None and is_closing_fence(lines[-1].strip(), fence):
+        count -= 1
+    return count
+
+
+def reference_definitions(text):
+    # 参照形式のリンク定義。ブロックごとに描画すると定義が届かないので、各ブロックに付け足して使う
+    return "\n".join(match.group(0) for match in REFERENCE_DEFINITION.finditer(text))
+
+
+def toggles_math(stripped):
+    return stripped.count("$$") % 2 == 1
+
+
+def continues_after_blank(line, stripped, list_block):
+    # 空行のあとでも、インデントされた行・引用・同じリストの次の項目は前のブロックの続き
+    return (
+        line[:1] in (" ", "\t")
+        or stripped.startswith(">")
+        or (list_block and LIST_MARKER.match(line) is not None)
+    )
+
+
+def split_markdown_blocks(text, final=True):
+    # final=False のときは未完了の末尾ブロックを残し、確定した位置までの文字数も返す
+    # 空行のあとに続きが来るかは次の行を見るまで分からないので、空行で終わる段落も未完了として扱う
+    blocks = []
+    kind = None
+    fence = None
+    start = 0
+    pos = 0
+    blank_at = None
+    in_math = False
+    list_block = False
+
+    for line in text.splitlines(keepends=True):
+        line_start = pos
+        pos += len(line)
+        if not final and not line.endswith("\n"):
+            pos = line_start
+            break
+        stripped = line.strip()
+
+        if kind == "code":
+            if line_start != start and is_closing_fence(stripped, fence):
+                blocks.append(("code", text[start:pos]))
+                kind = None
+            continue
+        if kind is None and not stripped:
+            continue
+
+        if kind is not None:
+            if not stripped:
+                if not in_math and blank_at is None:
+                    blank_at = line_start
+                continue
+            if blank_at is None:
+                if kind == "table" and stripped.startswith("|"):
+                    continue
+                if kind == "paragraph" and (in_math or opening_fence(stripped) is None or line[:1] in (" ", "\t")):
+                    in_math ^= toggles_math(stripped)
+                    continue
+            elif kind == "paragraph" and continues_after_blank(line, stripped, list_block):
+                blank_at = None
+                in_math ^= toggles_math(stripped)
+                continue
+            blocks.append((kind, text[start:blank_at if blank_at is not None else line_start]))
+
+        start = line_start
+        blank_at = None
+        fence = opening_fence(stripped)
+        if fence is not None:
+            kind = "code"
+        elif stripped.startswith("|"):
+            kind = "table"
+        else:
+            kind = "paragraph"
+            in_math = toggles_math(stripped)
+            list_block = LIST_MARKER.match(line) is not None
+
+    if kind is None:
+        return blocks, pos
+    if final:
+        end = blank_at if kind != "code" and blank_at is not None else len(text)
+        blocks.append((kind, text[start:end]))
+        return blocks, len(text)
+    return blocks, start
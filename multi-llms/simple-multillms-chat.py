@@ -1,5 +1,14 @@
+import collections
+import hashlib
+import io
+import json
+import logging
 import os
+import re
+import sys
+import tempfile
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
@@ -8,40 +17,755 @@ from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_xai import ChatXAI
+from conversation_archive import (
+    EXPORT_FORMATS,
+    archive_format,
+    iter_archive_records,
+    iter_archive_sessions,
+    iter_session_records,
+    validate_messages,
+    write_archive,
+)
+from markdown_blocks import (
+    code_body_line_count,
+    opening_fence,
+    reference_definitions,
+    split_markdown_blocks,
+)
+import threading
+import time
 import traceback
+import uuid
+import weakref
 
 openai_api_key = st.secrets.get("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY"))
 google_api_key = st.secrets.get("GOOGLE_API_KEY", os.getenv("GOOGLE_API_KEY"))
 anthropic_api_key = st.secrets.get("ANTHROPIC_API_KEY", os.getenv("ANTHROPIC_API_KEY"))
 xai_api_key = st.secrets.get("XAI_API_KEY", os.getenv("XAI_API_KEY"))
 
+logger = logging.getLogger(__name__)
 
-def select_model():
-    temperature = st.sidebar.slider(
-        "Temperature:",
-        min_value=0.0,
-        max_value=1.0,
-        value=0.7,
-        step=0.01,
-        help="値が大きいとランダムに、小さいと真面目になります。"
-    )
+AUTO_MODEL = "Auto"
+
+available_models = {
+    "ChatGPT 4.1": "gpt-4.1-2025-04-14",
+    "Gemini 2.5 Pro": "gemini-2.5-pro-exp-03-25",
+    "Claude 3.7 Sonnet": "claude-3-7-sonnet-latest",
+    "Grok-3 Mini": "grok-3-mini-fast-beta"
+}
+
+# --- Auto ルーティング用のモデル特性 ---
+# price: 100万トークンあたりのUSD (入力, 出力)、tier: 0=軽量 1=汎用 2=高性能、latency: 実測前に想定する最初のチャンクまでの時間(秒)
+model_profiles = {
+    "ChatGPT 4.1": {"api_key": openai_api_key, "price": (2.0, 8.0), "tier": 1, "latency": 0.8},
+    "Gemini 2.5 Pro": {"api_key": google_api_key, "price": (1.25, 10.0), "tier": 2, "latency": 4.0},
+    "Claude 3.7 Sonnet": {"api_key": anthropic_api_key, "price": (3.0, 15.0), "tier": 2, "latency": 1.2},
+    "Grok-3 Mini": {"api_key": xai_api_key, "price": (0.3, 0.5), "tier": 0, "latency": 0.5},
+}
+
+SHORT_PROMPT_TOKENS = 200
+LONG_PROMPT_TOKENS = 1500
+EXPECTED_OUTPUT_TOKENS = 500
+STATS_ALPHA = 0.3
+# 選ばれなくなったモデルも回復できるよう、エラー率は時間とともに半減させる
+ERROR_RATE_HALF_LIFE = 300
 
-    available_models = {
-        "ChatGPT 4.1": "gpt-4.1-2025-04-14",
-        "Gemini 2.5 Pro": "gemini-2.5-pro-exp-03-25",
-        "Claude 3.7 Sonnet": "claude-3-7-sonnet-latest",
-        "Grok-3 Mini": "grok-3-mini-fast-beta"
+
+def estimate_tokens(text):
+    # tiktoken では長文で1ms を超えるため、文字数からの概算で済ませる
+    # ASCII はおよそ4文字で1トークン、日本語などのマルチバイト文字は1文字1トークンとみなす
+    n_chars = len(text)
+    n_multibyte = (len(text.encode("utf-8")) - n_chars) // 2
+    return (n_chars - n_multibyte) // 4 + n_multibyte + 1
+
+
+@st.cache_resource
+def get_model_stats():
+    # 全セッションで共有する、モデルごとのレイテンシ・エラー率の移動平均
+    return {
+        "lock": threading.Lock(),
+        "models": {
+            name: {"latency": None, "error_rate": 0.0, "error_updated": 0.0, "calls": 0}
+            for name in available_models
+        },
     }
-    model_display_name = st.sidebar.radio(
-        "Choose a model:",
-        list(available_models.keys()),
-        index=0,
-        help="OpenAI、Google、XAI、Anthropicの最新モデルから選べます。"
+
+
+def decayed_error_rate(entry, now):
+    return entry["error_rate"] * 0.5 ** ((now - entry["error_updated"]) / ERROR_RATE_HALF_LIFE)
+
+
+def record_model_call(model_display_name, elapsed, succeeded):
+    stats = get_model_stats()
+    now = time.time()
+    with stats["lock"]:
+        entry = stats["models"][model_display_name]
+        entry["error_rate"] = decayed_error_rate(entry, now)
+        entry["error_updated"] = now
+        if succeeded:
+            if entry["latency"] is None:
+                entry["latency"] = elapsed
+            else:
+                entry["latency"] += STATS_ALPHA * (elapsed - entry["latency"])
+        entry["error_rate"] += STATS_ALPHA * ((0.0 if succeeded else 1.0) - entry["error_rate"])
+        entry["calls"] += 1
+
+
+def iter_model_stream(model, langchain_messages, model_display_name):
+    # 回答の長さや描画時間に左右されないよう、最初のチャンクまでの時間をレイテンシとして記録する
+    # 呼び出し側の描画で起きた例外はここには届かないので、失敗として数えるのはモデル側の例外だけ
+    start = time.perf_counter()
+    first_chunk = True
+    try:
+        for chunk in model.stream(langchain_messages):
+            if first_chunk:
+                record_model_call(model_display_name, time.perf_counter() - start, True)
+                first_chunk = False
+            yield chunk
+    except Exception:
+        record_model_call(model_display_name, time.perf_counter() - start, False)
+        raise
+
+
+def route_model(prompt_tokens, context_tokens, weights):
+    if prompt_tokens >= LONG_PROMPT_TOKENS:
+        required_tier, prompt_label = 2, "長文"
+    elif prompt_tokens >= SHORT_PROMPT_TOKENS:
+        required_tier, prompt_label = 1, "中程度"
+    else:
+        required_tier, prompt_label = 0, "短文"
+
+    models = get_model_stats()["models"]
+    now = time.time()
+    candidates = []
+    for name, profile in model_profiles.items():
+        if not profile["api_key"]:
+            continue
+        entry = models[name]
+        latency = entry["latency"] if entry["latency"] is not None else profile["latency"]
+        input_price, output_price = profile["price"]
+        cost = (context_tokens * input_price + EXPECTED_OUTPUT_TOKENS * output_price) / 1_000_000
+        candidates.append((name, profile["tier"], latency, decayed_error_rate(entry, now), cost))
+
+    if not candidates:
+        return None, "APIキーが設定されているモデルがありません。"
+
+    max_latency = max(c[2] for c in candidates) or 1.0
+    max_cost = max(c[4] for c in candidates) or 1.0
+
+    def score(candidate):
+        _, tier, latency, error_rate, cost = candidate
+        return (
+            weights["cost"] * cost / max_cost
+            + weights["latency"] * latency / max_latency
+            + weights["error"] * error_rate
+            + weights["quality"] * max(0, required_tier - tier)
+        )
+
+    name, _, latency, error_rate, cost = min(candidates, key=score)
+    reason = (
+        f"{prompt_label}の入力 (約{prompt_tokens} tokens) / "
+        f"初回応答までの平均 {latency:.1f}s / エラー率 {error_rate:.0%} / "
+        f"推定コスト ${cost:.4f}"
     )
+    return name, reason
+
+
+# --- セッション管理 (アイドル状態の会話をディスクへ退避) ---
+# 退避した会話を戻せるのは、同じ websocket セッションに戻ってきた場合だけ。
+# 再読み込みなどで新しい session_id になった場合や、Streamlit がセッションを破棄した場合は履歴も破棄する。
+SESSION_IDLE_TTL = int(os.getenv("SESSION_IDLE_TTL", "1800"))
+SESSION_SPILL_RETENTION = int(os.getenv("SESSION_SPILL_RETENTION", "86400"))
+SESSION_SWEEP_INTERVAL = 60
+SESSION_SPILL_DIR = os.getenv(
+    "SESSION_SPILL_DIR", os.path.join(tempfile.gettempdir(), "multillms-sessions")
+)
+
+
+class SessionMessages(list):
+    # レジストリから弱参照で持てるようにするための list。閉じたセッションの履歴を引き止めない
+    pass
+
+
+@st.cache_resource
+def get_session_registry():
+    # プロセス全体で共有するセッション一覧。ref は各セッションの st.session_state.messages への弱参照
+    os.makedirs(SESSION_SPILL_DIR, mode=0o700, exist_ok=True)
+    os.chmod(SESSION_SPILL_DIR, 0o700)
+    remove_stale_spill_files(time.time())
+    return {"lock": threading.Lock(), "sessions": {}, "last_sweep": 0.0}
+
+
+def remove_stale_spill_files(now):
+    # 以前のプロセスが残した退避ファイルはレジストリに載らないので、起動時に期限切れのものを消す
+    for name in os.listdir(SESSION_SPILL_DIR):
+        path = os.path.join(SESSION_SPILL_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > SESSION_SPILL_RETENTION:
+                os.remove(path)
+        except OSError as e:
+            logger.warning("古い退避ファイルの削除に失敗しました (%s): %s", name, e)
+
+
+def messages_footprint(messages):
+    return sum(sys.getsizeof(msg["content"]) for msg in messages)
+
+
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9-]+")
+
+
+def spill_path(session_id):
+    # session_id をそのままファイル名に使うので、想定外の文字を含むものは拒否する
+    if not SESSION_ID_PATTERN.fullmatch(session_id):
+        raise ValueError(f"不正な session_id です: {session_id!r}")
+    return os.path.join(SESSION_SPILL_DIR, f"{session_id}.json")
+
+
+def write_spill_file(session_id, messages):
+    path = spill_path(session_id)
+    fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(messages, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+    return os.path.getsize(path)
+
+
+def remove_spill_file(session_id):
+    try:
+        os.remove(spill_path(session_id))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("退避ファイルの削除に失敗しました (%s): %s", session_id, e)
+
+
+def read_spill_file(session_id):
+    with open(spill_path(session_id), encoding="utf-8") as f:
+        messages = json.load(f)
+    if not isinstance(messages, list):
+        raise ValueError(f"退避ファイルの形式が不正です: {session_id}")
+    return messages
+
+
+def sweep_sessions(registry, now):
+    # バックグラウンドで実行する。ロック中は対象の選別とスナップショットだけを行い、書き出しはロックの外で行う
+    to_spill = []
+    to_remove = []
+    with registry["lock"]:
+        for session_id, entry in list(registry["sessions"].items()):
+            messages = entry["ref"]()
+            idle = now - entry["last_seen"]
+            if messages is None or (entry["spilled"] and idle > SESSION_SPILL_RETENTION):
+                del registry["sessions"][session_id]
+                if entry["spilled"]:
+                    to_remove.append(session_id)
+            elif not entry["spilled"] and not entry["spilling"] and idle > SESSION_IDLE_TTL:
+                entry["spilling"] = True
+                to_spill.append((session_id, entry, list(messages), entry["last_seen"]))
+
+    for session_id in to_remove:
+        remove_spill_file(session_id)
+
+    for session_id, entry, snapshot, last_seen in to_spill:
+        try:
+            spilled_bytes = write_spill_file(session_id, snapshot)
+        except OSError as e:
+            logger.warning("セッションの退避に失敗しました (%s): %s", session_id, e)
+            with registry["lock"]:
+                entry["spilling"] = False
+            continue
+
+        with registry["lock"]:
+            entry["spilling"] = False
+            messages = entry["ref"]()
+            # 書き出している間にセッションが再開していたら退避を取り消す
+            resumed = (
+                messages is None
+                or registry["sessions"].get(session_id) is not entry
+                or entry["last_seen"] != last_seen
+                or len(messages) != len(snapshot)
+            )
+            if not resumed:
+                # 同じリストを参照しているセッション側からも中身が消え、メモリが解放される
+                messages.clear()
+                entry["spilled_bytes"] = spilled_bytes
+                entry["bytes"] = 0
+                entry["spilled"] = True
+        if resumed:
+            remove_spill_file(session_id)
+
+
+def track_session(messages):
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+
+    registry = get_session_registry()
+    now = time.time()
+    start_sweep = False
+    with registry["lock"]:
+        entry = registry["sessions"].get(ctx.session_id)
+        if entry is None or entry["ref"]() is not messages:
+            entry = {"ref": weakref.ref(messages), "spilled": False, "spilling": False, "spilled_bytes": 0}
+            registry["sessions"][ctx.session_id] = entry
+        needs_rehydrate = entry["spilled"]
+        entry["last_seen"] = now
+        entry["bytes"] = messages_footprint(messages)
+
+        if now - registry["last_sweep"] > SESSION_SWEEP_INTERVAL:
+            registry["last_sweep"] = now
+            start_sweep = True
+
+    if needs_rehydrate:
+        # ファイルの読み込みはロックの外で行い、反映する前にエントリが変わっていないか確かめる
+        try:
+            restored = read_spill_file(ctx.session_id)
+        except (OSError, ValueError) as e:
+            logger.warning("退避した会話の読み込みに失敗しました (%s): %s", ctx.session_id, e)
+            restored = []
+        with registry["lock"]:
+            if registry["sessions"].get(ctx.session_id) is entry and entry["spilled"]:
+                messages.extend(restored)
+                entry["spilled_bytes"] = 0
+                entry["spilled"] = False
+                entry["bytes"] = messages_footprint(messages)
+        # 読み込めなかったファイルも、二度と使われないので消しておく
+        remove_spill_file(ctx.session_id)
+
+    if start_sweep:
+        threading.Thread(target=sweep_sessions, args=(registry, now), daemon=True).start()
+
+
+def show_session_metrics():
+    registry = get_session_registry()
+    with registry["lock"]:
+        entries = list(registry["sessions"].values())
+        active_count = sum(1 for entry in entries if not entry["spilled"])
+        spilled_count = len(entries) - active_count
+        memory_bytes = sum(entry["bytes"] for entry in entries)
+        spilled_bytes = sum(entry["spilled_bytes"] for entry in entries)
+
+    with st.sidebar.expander("セッション統計", expanded=False):
+        st.metric("アクティブなセッション", active_count)
+        st.metric("ディスクに退避中のセッション", spilled_count)
+        st.metric("メモリ上の会話サイズ", f"{memory_bytes / 1024:.1f} KB")
+        st.metric("ディスク上の会話サイズ", f"{spilled_bytes / 1024:.1f} KB")
+
+
+# --- 会話のエクスポート / インポート ---
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(tempfile.gettempdir(), "multillms-exports"))
+# 一括取り込みした会話の保存先。各会話は新しく振った ID のファイルと index.jsonl の1行で管理する
+ARCHIVE_STORE_DIR = os.getenv(
+    "ARCHIVE_STORE_DIR", os.path.join(tempfile.gettempdir(), "multillms-archive")
+)
+ARCHIVE_LIST_LIMIT = 100
+CONVERSATION_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+# 全セッションの一括エクスポート / インポートと保存済み会話の閲覧は運用者向け。MULTILLMS_ADMIN=1 のときだけ表示する
+ADMIN_MODE = os.getenv("MULTILLMS_ADMIN", "") == "1"
+
+
+def iter_persistent_records():
+    # メモリ上のセッションとディスクに退避したセッションを1件ずつ読み出す
+    registry = get_session_registry()
+    with registry["lock"]:
+        session_ids = list(registry["sessions"])
+
+    for session_id in session_ids:
+        with registry["lock"]:
+            entry = registry["sessions"].get(session_id)
+            messages = entry["ref"]() if entry is not None else None
+            if messages is None:
+                continue
+            spilled = entry["spilled"]
+            if not spilled:
+                messages = list(messages)
+
+        if spilled:
+            # ファイルの読み込みはロックの外で行う。読めなかった場合は、その間に戻されていないか確かめる
+            try:
+                messages = read_spill_file(session_id)
+            except (OSError, ValueError) as e:
+                with registry["lock"]:
+                    live = entry["ref"]()
+                    messages = None if entry["spilled"] or live is None else list(live)
+                if messages is None:
+                    # 壊れた退避ファイルはそのセッションだけ飛ばす
+                    logger.warning("退避した会話を書き出せませんでした (%s): %s", session_id, e)
+                    continue
+        yield from iter_session_records(session_id, messages)
+
+
+def export_conversation(session_id, messages, fmt):
+    buffer = io.BytesIO()
+    write_archive(iter_session_records(session_id, messages), buffer, fmt)
+    return buffer.getvalue()
+
+
+def import_conversation(fileobj, fmt, system_prompt):
+    imported = None
+    for _, messages in iter_archive_sessions(iter_archive_records(fileobj, fmt)):
+        if imported is not None:
+            raise ValueError("複数の会話が含まれています。一括インポートを使ってください。")
+        imported = messages
+    if imported is None:
+        raise ValueError("アーカイブに会話が含まれていません。")
+    return validate_messages(imported, system_prompt)
+
+
+def replace_conversation(messages, new_messages):
+    # セッション管理と同じリストを共有しているので、中身だけを入れ替える
+    messages[:] = new_messages
+    st.session_state.pop("export_file", None)
+
+
+def archive_index_path():
+    return os.path.join(ARCHIVE_STORE_DIR, "index.jsonl")
+
+
+def store_conversation(messages, source_session_id):
+    # アーカイブ内の session_id はパスに使わず、新しい ID を振って保存する
+    conversation_id = uuid.uuid4().hex
+    path = os.path.join(ARCHIVE_STORE_DIR, f"{conversation_id}.json")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(messages, f, ensure_ascii=False)
+    title = next((msg["content"] for msg in messages if msg["role"] == "user"), "")
+    return {
+        "id": conversation_id,
+        "title": " ".join(title.split())[:60],
+        "message_count": len(messages),
+        "source": str(source_session_id)[:64],
+        "imported_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def load_archive_index(index_mtime, query):
+    # index.jsonl を1行ずつ読み、条件に合う新しいものから最大 ARCHIVE_LIST_LIMIT 件を返す
+    # index_mtime は取り込みのたびにキャッシュを作り直すための引数
+    matches = collections.deque(maxlen=ARCHIVE_LIST_LIMIT)
+    with open(archive_index_path(), encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            if query in entry["title"] or query in entry["source"]:
+                matches.append(entry)
+    return list(reversed(matches))
 
-    model_name = available_models[model_display_name]
-    st.session_state.model_name = model_name
 
+def load_stored_conversation(conversation_id, system_prompt):
+    if not CONVERSATION_ID_PATTERN.fullmatch(conversation_id):
+        raise ValueError(f"不正な会話 ID です: {conversation_id!r}")
+    with open(os.path.join(ARCHIVE_STORE_DIR, f"{conversation_id}.json"), encoding="utf-8") as f:
+        messages = json.load(f)
+    if not isinstance(messages, list):
+        raise ValueError("保存された会話の形式が不正です。")
+    return validate_messages(messages, system_prompt)
+
+
+@st.cache_resource
+def get_archive_jobs():
+    return {"lock": threading.Lock(), "current": None}
+
+
+def count_records(records, job):
+    for record in records:
+        job["records"] += 1
+        yield record
+
+
+def run_archive_job(job, work):
+    status = "done"
+    try:
+        work(job)
+    except Exception as e:
+        status = "error"
+        job["message"] = str(e)
+        logger.exception("アーカイブの処理に失敗しました")
+    job["elapsed"] = time.perf_counter() - job["started"]
+    # 画面側は status を見てほかの項目を読むので、最後に更新する
+    job["status"] = status
+
+
+def start_archive_job(kind, work):
+    jobs = get_archive_jobs()
+    with jobs["lock"]:
+        current = jobs["current"]
+        if current is not None and current["status"] == "running":
+            return False
+        job = {"kind": kind, "status": "running", "records": 0, "sessions": 0, "skipped": 0,
+               "path": None, "message": None, "started": time.perf_counter(), "elapsed": None}
+        jobs["current"] = job
+    threading.Thread(target=run_archive_job, args=(job, work), daemon=True).start()
+    return True
+
+
+def bulk_export(job, fmt):
+    os.makedirs(EXPORT_DIR, mode=0o700, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"conversations-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}")
+    fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        write_archive(count_records(iter_persistent_records(), job), f, fmt)
+    os.replace(path + ".tmp", path)
+    job["path"] = path
+
+
+def bulk_import(job, fileobj, fmt, system_prompt):
+    os.makedirs(ARCHIVE_STORE_DIR, mode=0o700, exist_ok=True)
+    fd = os.open(archive_index_path(), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    with os.fdopen(fd, "a", encoding="utf-8") as index:
+        records = count_records(iter_archive_records(fileobj, fmt), job)
+        for source_session_id, messages in iter_archive_sessions(records):
+            try:
+                validate_messages(messages, system_prompt)
+            except ValueError as e:
+                logger.warning("会話を取り込めませんでした (%s): %s", source_session_id, e)
+                job["skipped"] += 1
+                continue
+            entry = store_conversation(messages, source_session_id)
+            index.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            job["sessions"] += 1
+
+
+def show_conversation_archive(panel, system_prompt):
+    ctx = get_script_run_ctx()
+    session_id = ctx.session_id if ctx is not None else "local"
+    messages = st.session_state.messages
+
+    with panel.expander("会話のエクスポート / インポート", expanded=False):
+        format_label = st.radio("形式:", list(EXPORT_FORMATS.keys()), key="export_format")
+        fmt = EXPORT_FORMATS[format_label]
+        # 毎回の再実行でシリアライズしないよう、ボタンを押したときだけ作る
+        if st.button("ダウンロードを準備する"):
+            st.session_state.export_file = {
+                "data": export_conversation(session_id, messages, fmt),
+                "fmt": fmt,
+                "message_count": len(messages),
+                "file_name": f"conversation-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}",
+            }
+        export_file = st.session_state.get("export_file")
+        if export_file is not None:
+            if export_file["fmt"] == fmt and export_file["message_count"] == len(messages):
+                st.download_button(
+                    "この会話をダウンロード",
+                    data=export_file["data"],
+                    file_name=export_file["file_name"],
+                    mime="application/octet-stream",
+                )
+            else:
+                # 会話が進んだか形式が変わったので、古いデータは捨てる
+                del st.session_state.export_file
+
+        uploaded = st.file_uploader("会話を読み込む", type=["gz", "parquet"], key="import_conversation")
+        if uploaded is not None and st.button("この会話を置き換える"):
+            try:
+                imported = import_conversation(uploaded, archive_format(uploaded.name), system_prompt)
+            except Exception as e:
+                st.error(f"会話の読み込みに失敗しました: {e}")
+            else:
+                replace_conversation(messages, imported)
+                st.rerun()
+
+    if not ADMIN_MODE:
+        return
+
+    with panel.expander("一括エクスポート / インポート (管理者)", expanded=False):
+        if st.button("全セッションをバックグラウンドで書き出す"):
+            if not start_archive_job("export", lambda job: bulk_export(job, fmt)):
+                st.warning("別の処理が実行中です。")
+
+        bulk_uploaded = st.file_uploader("アーカイブを取り込む", type=["gz", "parquet"], key="import_archive")
+        if bulk_uploaded is not None and st.button("バックグラウンドで取り込む"):
+            import_format = archive_format(bulk_uploaded.name)
+            if not start_archive_job("import", lambda job: bulk_import(job, bulk_uploaded, import_format, system_prompt)):
+                st.warning("別の処理が実行中です。")
+
+        job = get_archive_jobs()["current"]
+        if job is not None:
+            kind = "書き出し" if job["kind"] == "export" else "取り込み"
+            if job["status"] == "running":
+                st.info(f"{kind}中... {job['records']} 件")
+            elif job["status"] == "done":
+                st.success(f"{kind}が完了しました: {job['records']} 件 ({job['elapsed']:.1f}s)")
+                if job["kind"] == "export":
+                    st.caption(f"保存先: {job['path']}")
+                else:
+                    st.caption(f"保存した会話: {job['sessions']} 件 / 不正でスキップ: {job['skipped']} 件")
+            else:
+                st.error(f"{kind}に失敗しました: {job['message']}")
+
+    with panel.expander("保存済みの会話 (管理者)", expanded=False):
+        if not os.path.exists(archive_index_path()):
+            st.caption("取り込んだ会話はまだありません。")
+            return
+        query = st.text_input("タイトル / 元セッションで検索", key="archive_query")
+        entries = load_archive_index(os.path.getmtime(archive_index_path()), query)
+        if not entries:
+            st.caption("該当する会話がありません。")
+            return
+        selected = st.selectbox(
+            f"会話 (新しい順に最大 {ARCHIVE_LIST_LIMIT} 件)",
+            entries,
+            format_func=lambda entry: f"{entry['imported_at']} {entry['title']} ({entry['message_count']}件)",
+            key="archive_selected",
+        )
+        if st.button("この会話を読み込む"):
+            try:
+                loaded = load_stored_conversation(selected["id"], system_prompt)
+            except (OSError, ValueError) as e:
+                st.error(f"会話の読み込みに失敗しました: {e}")
+            else:
+                replace_conversation(messages, loaded)
+                st.rerun()
+
+
+# --- 回答の描画 (ブロック単位の差分描画) ---
+CODE_COLLAPSE_LINES = 30
+# 受信中の末尾ブロックを書き換える最短間隔(秒)。チャンクごとに送り直すと長い段落で二乗のペイロードになる
+STREAM_UPDATE_INTERVAL = 0.1
+
+
+@st.cache_data(max_entries=1000, show_spinner=False)
+def parse_message_blocks(content):
+    blocks, _ = split_markdown_blocks(content)
+    parsed = [
+        (kind, text, hashlib.sha1(text.encode("utf-8")).hexdigest()[:12])
+        for kind, text in blocks
+    ]
+    return parsed, reference_definitions(content)
+
+
+def render_block(kind, text, key, interactive=True, references=""):
+    # 送信したバイト数を返す。長いコードは開くまで本文を送らない
+    # ストリーミング中に操作されると再実行で応答が途切れるため、interactive=False では見出しだけを出す
+    line_count = code_body_line_count(text) if kind == "code" else 0
+    if line_count > CODE_COLLAPSE_LINES:
+        language = text.strip().split("\n", 1)[0].strip("`~ ") or "text"
+        label = f"📄 {language} のコード ({line_count} 行) を表示"
+        if not interactive:
+            st.caption(label)
+            return len(label.encode("utf-8"))
+        if st.toggle(label, key=f"code-{key}"):
+            st.markdown(text)
+            return len(label.encode("utf-8")) + len(text.encode("utf-8"))
+        return len(label.encode("utf-8"))
+    if references and kind != "code":
+        text = f"{text}\n\n{references}"
+    st.markdown(text)
+    return len(text.encode("utf-8"))
+
+
+def render_message(content, message_key):
+    blocks, references = parse_message_blocks(content)
+    sent_bytes = 0
+    for i, (kind, text, digest) in enumerate(blocks):
+        sent_bytes += render_block(kind, text, f"{message_key}-{i}-{digest}", references=references)
+    return sent_bytes
+
+
+def chunk_text(chunk):
+    content = chunk.content if isinstance(chunk, AIMessage) else chunk
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(
+            part if isinstance(part, str) else part.get("text", "")
+            for part in content
+        )
+    raise ValueError(f"予期しない応答形式を受け取りました: {type(chunk)}")
+
+
+def stream_response(chunks, message_key):
+    # 確定したブロックは一度だけ描画し、以降は末尾の未完了ブロックだけを書き換える
+    response_text = ""
+    done_upto = 0
+    block_index = 0
+    total_bytes = 0
+    last_update = 0.0
+    # single_bytes: 従来の invoke で回答を1回だけ描画した場合、naive_bytes: チャンクごとに全文を描画した場合
+    stats = {"single_bytes": 0, "naive_bytes": 0, "sent_bytes": 0}
+    tail = st.empty()
+
+    def flush(blocks):
+        nonlocal tail, block_index
+        for kind, text in blocks:
+            digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+            with tail.container():
+                stats["sent_bytes"] += render_block(
+                    kind, text, f"{message_key}-{block_index}-{digest}", interactive=False
+                )
+            block_index += 1
+            tail = st.empty()
+
+    for chunk in chunks:
+        piece = chunk_text(chunk)
+        if not piece:
+            continue
+        response_text += piece
+        total_bytes += len(piece.encode("utf-8"))
+        stats["naive_bytes"] += total_bytes
+
+        blocks, consumed = split_markdown_blocks(response_text[done_upto:], final=False)
+        flush(blocks)
+        done_upto += consumed
+        pending = response_text[done_upto:]
+        now = time.perf_counter()
+        if not pending or now - last_update < STREAM_UPDATE_INTERVAL:
+            continue
+        last_update = now
+        is_code = opening_fence(pending.lstrip()) is not None
+        pending_lines = code_body_line_count(pending) if is_code else 0
+        if pending_lines > CODE_COLLAPSE_LINES:
+            # 長いコードは折りたたんで表示するので、受信中も本文は送らない
+            pending = f"📄 コードを受信中... ({pending_lines} 行)"
+            tail.caption(pending)
+        else:
+            tail.markdown(pending)
+        stats["sent_bytes"] += len(pending.encode("utf-8"))
+
+    blocks, _ = split_markdown_blocks(response_text[done_upto:], final=True)
+    tail.empty()
+    flush(blocks)
+    stats["single_bytes"] = total_bytes
+    return response_text, stats
+
+
+def show_render_metrics(full_bytes, sent_bytes):
+    with st.sidebar.expander("描画ペイロード", expanded=False):
+        st.metric(
+            "履歴の再描画",
+            f"{sent_bytes / 1024:.1f} KB",
+            delta=f"{(sent_bytes - full_bytes) / 1024:+.1f} KB",
+            delta_color="inverse",
+            help=f"全文を描画した場合: {full_bytes / 1024:.1f} KB",
+        )
+        stream_stats = st.session_state.get("stream_stats")
+        if stream_stats:
+            # 従来は回答全体を1回だけ描画していたので、差分はその描画との比較で示す
+            st.metric(
+                "直近の回答のストリーミング",
+                f"{stream_stats['sent_bytes'] / 1024:.1f} KB",
+                delta=f"{(stream_stats['sent_bytes'] - stream_stats['single_bytes']) / 1024:+.1f} KB",
+                delta_color="inverse",
+                help=(
+                    f"従来どおり1回だけ描画した場合: {stream_stats['single_bytes'] / 1024:.1f} KB / "
+                    f"チャンクごとに全文を描画した場合: {stream_stats['naive_bytes'] / 1024:.1f} KB"
+                ),
+            )
+
+
+def select_route_weights():
+    with st.sidebar.expander("Auto ルーティングの重み", expanded=False):
+        weights = {
+            "cost": st.slider("コスト", 0.0, 3.0, 1.0, 0.1),
+            "latency": st.slider("レイテンシ", 0.0, 3.0, 1.0, 0.1),
+            "error": st.slider("エラー率", 0.0, 5.0, 2.0, 0.1),
+            "quality": st.slider("性能不足のペナルティ", 0.0, 3.0, 1.5, 0.1),
+        }
+    return weights
+
+
+def create_model(model_display_name, temperature):
+    model_name = available_models[model_display_name]
     model = None
     error_message = None
 
@@ -95,67 +819,137 @@ def select_model():
 
     return model, error_message
 
+def select_model():
+    temperature = st.sidebar.slider(
+        "Temperature:",
+        min_value=0.0,
+        max_value=1.0,
+        value=0.7,
+        step=0.01,
+        help="値が大きいとランダムに、小さいと真面目になります。"
+    )
+
+    model_display_name = st.sidebar.radio(
+        "Choose a model:",
+        list(available_models.keys()) + [AUTO_MODEL],
+        index=0,
+        help="OpenAI、Google、XAI、Anthropicの最新モデルから選べます。Autoは入力の長さと実測のレイテンシ・エラー率から毎回選びます。"
+    )
+
+    if model_display_name == AUTO_MODEL:
+        st.session_state.model_name = AUTO_MODEL
+        route_config = {"temperature": temperature, "weights": select_route_weights()}
+        return None, None, route_config
+
+    st.session_state.model_name = available_models[model_display_name]
+    st.session_state.model_display_name = model_display_name
+
+    model, error_message = create_model(model_display_name, temperature)
+    return model, error_message, None
+
+def respond(user_input, model, route_config):
+    st.session_state.messages.append({"role": "user", "content": user_input})
+    with st.chat_message("user"):
+        st.markdown(user_input)
+
+    langchain_messages = []
+    for msg in st.session_state.messages:
+        if msg["role"] == "system":
+            langchain_messages.append(SystemMessage(content=msg["content"]))
+        elif msg["role"] == "user":
+            langchain_messages.append(HumanMessage(content=msg["content"]))
+        elif msg["role"] == "assistant":
+            langchain_messages.append(AIMessage(content=msg["content"]))
+
+    route = None
+    if route_config is not None:
+        route_start = time.perf_counter()
+        context_tokens = sum(estimate_tokens(msg["content"]) for msg in st.session_state.messages)
+        routed_name, reason = route_model(
+            estimate_tokens(user_input), context_tokens, route_config["weights"]
+        )
+        route_ms = (time.perf_counter() - route_start) * 1000
+        if routed_name is None:
+            st.error(f"モデルを自動選択できませんでした: {reason}")
+            return
+        model, error_message = create_model(routed_name, route_config["temperature"])
+        if error_message or model is None:
+            st.error(f"モデルの準備ができませんでした: {error_message}")
+            return
+        st.session_state.model_name = available_models[routed_name]
+        st.session_state.model_display_name = routed_name
+        route = f"{routed_name} — {reason} (ルーティング {route_ms:.2f} ms)"
+
+    with st.spinner(f"{st.session_state.model_name} is thinking..."):
+        try:
+            with st.chat_message("assistant"):
+                chunks = iter_model_stream(
+                    model, langchain_messages, st.session_state.model_display_name
+                )
+                response_text, stream_stats = stream_response(chunks, len(st.session_state.messages))
+                if route:
+                    st.caption(f"🔀 Auto: {route}")
+
+            assistant_message = {"role": "assistant", "content": response_text}
+            if route:
+                assistant_message["route"] = route
+            st.session_state.messages.append(assistant_message)
+            st.session_state.stream_stats = stream_stats
+
+        except Exception as e:
+            st.error(f"応答の生成中にエラーが発生しました: {e}")
+            st.error("詳細情報:")
+            st.error(traceback.format_exc())
+
 def main():
     st.set_page_config(page_title="My Great LLM's", page_icon="🤗")
     st.header("My Great LLM's 🤗")
 
-    model, error_message = select_model()
+    model, error_message, route_config = select_model()
 
     if error_message:
         st.error(f"モデルの準備ができませんでした: {error_message}")
         st.warning("サイドバーで別のモデルを選択するか、APIキーの設定を確認してください。")
         return
-    if model is None:
+    if model is None and route_config is None:
         st.error("モデルオブジェクトが正常に作成されませんでした。原因不明のエラーです。")
         return
 
     system_prompt = "You are a helpful assistant."
 
     if "messages" not in st.session_state:
-        st.session_state.messages = [{"role": "system", "content": system_prompt}]
+        st.session_state.messages = SessionMessages([{"role": "system", "content": system_prompt}])
+
+    track_session(st.session_state.messages)
+    if not st.session_state.messages:
+        # 保存期間を過ぎて退避した履歴が削除された、または読み込めなかった場合
+        st.session_state.messages.append({"role": "system", "content": system_prompt})
+        st.info("しばらく操作がなかったため、以前の会話履歴は削除されました。")
+    show_session_metrics()
+    archive_panel = st.sidebar.container()
 
-    for message in st.session_state.messages:
-        if message["role"] != "system":
-            with st.chat_message(message["role"]):
+    full_bytes = 0
+    sent_bytes = 0
+    for i, message in enumerate(st.session_state.messages):
+        if message["role"] == "system":
+            continue
+        with st.chat_message(message["role"]):
+            if message["role"] == "assistant":
+                full_bytes += len(message["content"].encode("utf-8"))
+                sent_bytes += render_message(message["content"], i)
+            else:
                 st.markdown(message["content"])
+            if "route" in message:
+                st.caption(f"🔀 Auto: {message['route']}")
+    show_render_metrics(full_bytes, sent_bytes)
 
     user_input = st.chat_input("聞きたいことを入力してね！")
 
     if user_input:
-        st.session_state.messages.append({"role": "user", "content": user_input})
-        with st.chat_message("user"):
-            st.markdown(user_input)
-
-        langchain_messages = []
-        for msg in st.session_state.messages:
-            if msg["role"] == "system":
-                langchain_messages.append(SystemMessage(content=msg["content"]))
-            elif msg["role"] == "user":
-                langchain_messages.append(HumanMessage(content=msg["content"]))
-            elif msg["role"] == "assistant":
-                langchain_messages.append(AIMessage(content=msg["content"]))
-
-        with st.spinner(f"{st.session_state.model_name} is thinking..."):
-            try:
-                response = model.invoke(langchain_messages)
-
-                if isinstance(response, AIMessage):
-                    response_text = response.content
-                elif isinstance(response, str):
-                     response_text = response
-                else:
-                    st.error(f"予期しない応答形式を受け取りました: {type(response)}")
-                    response_text = f"エラー: 応答の解析に失敗しました。形式: {type(response)}"
-                    st.error(f"応答内容: {response}")
+        respond(user_input, model, route_config)
 
-                st.session_state.messages.append({"role": "assistant", "content": response_text})
-                with st.chat_message("assistant"):
-                    st.markdown(response_text)
-
-            except Exception as e:
-                st.error(f"応答の生成中にエラーが発生しました: {e}")
-                st.error("詳細情報:")
-                st.error(traceback.format_exc())
+    # 今回のやり取りを履歴に加えた後で描画する
+    show_conversation_archive(archive_panel, system_prompt)
 
 if __name__ == "__main__":
     main()
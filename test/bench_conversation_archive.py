@@ -0,0 +1,82 @@
+# 会話アーカイブの書き出し / 読み込みのスループットを計測する
+# 使い方: python test/bench_conversation_archive.py --sessions 10000 --messages 20
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "multi-llms"))
+
+from conversation_archive import EXPORT_FORMATS, iter_archive_records, write_archive
+
+CONTENT_POOL_SIZE = 2000
+WORDS = (
+    "the model answer question context token stream latency cache session export "
+    "import archive python code table data user assistant result error value "
+    "会話 回答 質問 モデル 設定 エラー 結果 データ 表示 処理 速度 保存 読み込み 書き出し"
+).split()
+
+
+def make_content(rng):
+    # 実際の会話に近づけるため、長さ・語彙・コードの有無をばらつかせる
+    words = [rng.choice(WORDS) for _ in range(rng.randint(5, 400))]
+    content = " ".join(words) + f" {rng.getrandbits(64):x}"
+    if rng.random() < 0.2:
+        lines = "\n".join(f"x_{i} = {rng.random():.6f}" for i in range(rng.randint(3, 60)))
+        content += f"\n\n```python\n{lines}\n```\n"
+    return content
+
+
+def iter_benchmark_records(session_count, messages_per_session, pool, stats, seed):
+    # 本文の生成時間を計測に含めないよう、事前に作ったプールから選ぶ
+    rng = random.Random(seed)
+    for s in range(session_count):
+        session_id = f"bench-{s:06d}"
+        for i in range(messages_per_session):
+            content = rng.choice(pool)
+            stats["raw_bytes"] += len(content.encode("utf-8"))
+            yield {
+                "session_id": session_id,
+                "index": i,
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": content,
+                "route": None,
+            }
+
+
+def run(session_count, messages_per_session, seed):
+    record_count = session_count * messages_per_session
+    rng = random.Random(seed)
+    pool = [make_content(rng) for _ in range(CONTENT_POOL_SIZE)]
+    print(f"{session_count} セッション x {messages_per_session} メッセージ = {record_count} レコード")
+    for label, fmt in EXPORT_FORMATS.items():
+        stats = {"raw_bytes": 0}
+        with tempfile.TemporaryFile() as f:
+            start = time.perf_counter()
+            write_archive(iter_benchmark_records(session_count, messages_per_session, pool, stats, seed), f, fmt)
+            write_seconds = time.perf_counter() - start
+            archive_mb = f.tell() / 1024 / 1024
+
+            f.seek(0)
+            start = time.perf_counter()
+            read_count = sum(1 for _ in iter_archive_records(f, fmt))
+            read_seconds = time.perf_counter() - start
+
+        raw_mb = stats["raw_bytes"] / 1024 / 1024
+        assert read_count == record_count
+        print(
+            f"{label:13s} 元データ {raw_mb:8.1f} MB / アーカイブ {archive_mb:7.1f} MB | "
+            f"書き出し {record_count / write_seconds:9.0f} records/s {raw_mb / write_seconds:6.1f} MB/s | "
+            f"読み込み {read_count / read_seconds:9.0f} records/s {raw_mb / read_seconds:6.1f} MB/s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="会話アーカイブのスループット計測")
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.sessions, args.messages, args.seed)
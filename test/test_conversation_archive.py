@@ -0,0 +1,90 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "multi-llms"))
+
+from conversation_archive import (
+    archive_format,
+    iter_archive_records,
+    iter_archive_sessions,
+    iter_session_records,
+    validate_messages,
+    write_archive,
+)
+
+MESSAGES = [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": "こんにちは"},
+    {"role": "assistant", "content": "```py\nprint(1)\n```", "route": "Grok-3 Mini — 短文"},
+]
+
+
+def round_trip(records, fmt):
+    buffer = io.BytesIO()
+    write_archive(records, buffer, fmt)
+    buffer.seek(0)
+    return list(iter_archive_records(buffer, fmt))
+
+
+def test_jsonl_round_trip():
+    records = list(iter_session_records("a", MESSAGES))
+    assert round_trip(iter(records), "jsonl.gz") == records
+
+
+def test_parquet_round_trip():
+    pytest.importorskip("pyarrow")
+    records = list(iter_session_records("a", MESSAGES))
+    assert round_trip(iter(records), "parquet") == records
+
+
+def test_round_trip_spans_batches():
+    records = [
+        {"session_id": f"s{i // 7}", "index": i % 7, "role": "user", "content": f"m{i}", "route": None}
+        for i in range(2500)
+    ]
+    assert round_trip(iter(records), "jsonl.gz") == records
+
+
+def test_iter_archive_sessions_groups_consecutive_records():
+    records = list(iter_session_records("a", MESSAGES)) + list(iter_session_records("b", MESSAGES[:2]))
+    sessions = list(iter_archive_sessions(records))
+    assert [session_id for session_id, _ in sessions] == ["a", "b"]
+    assert sessions[0][1] == MESSAGES
+    assert sessions[1][1] == MESSAGES[:2]
+
+
+def test_iter_archive_sessions_rejects_non_dict_records():
+    with pytest.raises(ValueError):
+        list(iter_archive_sessions(["not a record"]))
+
+
+@pytest.mark.parametrize("message", [
+    {"role": "tool", "content": "x"},
+    {"role": None, "content": "x"},
+    {"role": "user", "content": None},
+    {"role": "user", "content": 1},
+    {"role": "user"},
+    "not a message",
+    {"role": "assistant", "content": "x", "route": 3},
+])
+def test_validate_messages_rejects_bad_messages(message):
+    with pytest.raises(ValueError):
+        validate_messages([dict(MESSAGES[0]), message], "system")
+
+
+def test_validate_messages_inserts_missing_system_prompt():
+    messages = validate_messages([{"role": "user", "content": "hi"}], "system")
+    assert messages == [{"role": "system", "content": "system"}, {"role": "user", "content": "hi"}]
+
+
+def test_validate_messages_keeps_existing_system_prompt():
+    messages = [dict(message) for message in MESSAGES]
+    assert validate_messages(messages, "other") == MESSAGES
+
+
+def test_archive_format():
+    assert archive_format("conversations.parquet") == "parquet"
+    assert archive_format("conversation.jsonl.gz") == "jsonl.gz"
@@ -0,0 +1,147 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "multi-llms"))
+
+from markdown_blocks import code_body_line_count, reference_definitions, split_markdown_blocks
+
+SAMPLE = (
+    "# Title\n"
+    "\n"
+    "Some para\n"
+    "line two\n"
+    "\n"
+    "| a | b |\n"
+    "|---|---|\n"
+    "| 1 | 2 |\n"
+    "after table\n"
+    "\n"
+    "```python\n"
+    "x = 1\n"
+    "\n"
+    "y = 2\n"
+    "```\n"
+    "\n"
+    "End."
+)
+
+
+def kinds(blocks):
+    return [kind for kind, _ in blocks]
+
+
+def test_block_kinds():
+    blocks, consumed = split_markdown_blocks(SAMPLE)
+    assert kinds(blocks) == ["paragraph", "paragraph", "table", "paragraph", "code", "paragraph"]
+    assert blocks[4][1] == "```python\nx = 1\n\ny = 2\n```\n"
+    assert consumed == len(SAMPLE)
+
+
+def test_blocks_cover_text():
+    blocks, _ = split_markdown_blocks(SAMPLE)
+    assert "".join(text for _, text in blocks).replace("\n", "") == SAMPLE.replace("\n", "")
+
+
+def test_incremental_matches_final():
+    for step in (1, 3, 7, 50):
+        blocks = []
+        text = ""
+        done_upto = 0
+        for i in range(0, len(SAMPLE), step):
+            text += SAMPLE[i:i + step]
+            finished, consumed = split_markdown_blocks(text[done_upto:], final=False)
+            blocks.extend(finished)
+            done_upto += consumed
+        finished, _ = split_markdown_blocks(text[done_upto:], final=True)
+        blocks.extend(finished)
+        assert blocks == split_markdown_blocks(SAMPLE)[0]
+
+
+def test_unfinished_code_block_is_kept_as_tail():
+    text = "Intro\n\n```py\nx = 1\n"
+    blocks, consumed = split_markdown_blocks(text, final=False)
+    assert blocks == [("paragraph", "Intro\n")]
+    assert text[consumed:] == "```py\nx = 1\n"
+
+
+def test_nested_fence_does_not_close_outer_block():
+    text = "````md\n```py\nx\n```\n````\n"
+    blocks, _ = split_markdown_blocks(text)
+    assert blocks == [("code", text)]
+
+
+def test_closing_fence_must_use_same_character():
+    text = "~~~\n```\ncode\n```\n~~~~\n\nafter\n"
+    blocks, _ = split_markdown_blocks(text)
+    assert kinds(blocks) == ["code", "paragraph"]
+    assert blocks[0][1] == "~~~\n```\ncode\n```\n~~~~\n"
+
+
+def test_indented_fence():
+    text = "  ```py\n  x = 1\n  ```\n\nafter\n"
+    blocks, _ = split_markdown_blocks(text)
+    assert kinds(blocks) == ["code", "paragraph"]
+    assert blocks[0][1] == "  ```py\n  x = 1\n  ```\n"
+
+
+def test_indented_fence_stays_in_list_item():
+    text = "1. Step one\n\n   ```sh\n   ls -la\n   ```\n\nDone\n"
+    blocks, _ = split_markdown_blocks(text)
+    assert blocks == [
+        ("paragraph", "1. Step one\n\n   ```sh\n   ls -la\n   ```\n"),
+        ("paragraph", "Done\n"),
+    ]
+
+
+def test_nested_list_after_blank_line():
+    text = "- a\n\n    - nested\n"
+    blocks, _ = split_markdown_blocks(text)
+    assert blocks == [("paragraph", text)]
+
+
+def test_loose_list_is_one_block():
+    text = "1. first\n\n2. second\n\nafter\n"
+    blocks, _ = split_markdown_blocks(text)
+    assert blocks == [("paragraph", "1. first\n\n2. second\n"), ("paragraph", "after\n")]
+
+
+def test_indented_code_after_blank_lines():
+    text = "x\n\n    code1\n\n    code2"
+    blocks, _ = split_markdown_blocks(text)
+    assert blocks == [("paragraph", text)]
+
+
+def test_blockquote_paragraphs():
+    text = "> first\n\n> second\n\nafter\n"
+    blocks, _ = split_markdown_blocks(text)
+    assert blocks == [("paragraph", "> first\n\n> second\n"), ("paragraph", "after\n")]
+
+
+def test_math_block_with_blank_line():
+    text = "$$\na = b\n\nc = d\n$$\n\nafter\n"
+    blocks, _ = split_markdown_blocks(text)
+    assert blocks == [("paragraph", "$$\na = b\n\nc = d\n$$\n"), ("paragraph", "after\n")]
+
+
+def test_incremental_matches_final_across_blank_lines():
+    text = "- a\n\n    - nested\n\n$$\nx\n\ny\n$$\n\n> q\n\n> r\n\nend\n"
+    blocks = []
+    done_upto = 0
+    for i in range(1, len(text) + 1):
+        finished, consumed = split_markdown_blocks(text[done_upto:i], final=False)
+        blocks.extend(finished)
+        done_upto += consumed
+    blocks.extend(split_markdown_blocks(text[done_upto:], final=True)[0])
+    assert blocks == split_markdown_blocks(text)[0]
+
+
+def test_reference_definitions():
+    text = "See [docs][1].\n\nMore text.\n\n[1]: https://example.com\n"
+    assert reference_definitions(text) == "[1]: https://example.com"
+
+
+def test_code_body_line_count():
+    body = "".join(f"line {i}\n" for i in range(40))
+    assert code_body_line_count("```py\n" + body + "```\n") == 40
+    assert code_body_line_count("```py\n" + body) == 40
+    assert code_body_line_count("````md\n```\n````\n") == 1